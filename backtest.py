@@ -0,0 +1,320 @@
+import sys
+import time
+import sqlite3
+import numpy as np
+from datetime import datetime
+from item import create_tables
+from recipe import load_recipe_definitions, build_recipe_arrays
+
+BUCKET_MINUTES = 60
+# Buckets in which every item of a recipe is at least this liquid count as tradable
+LIQUID_MIN_LIQUIDITY = 3
+
+
+class PriceHistory:
+
+    def __init__(self, item_names, timestamps, prices, liquidity):
+        """
+        Price and liquidity time series of all items, aligned on common time buckets
+        A bucket without a fresh observation carries the last known value forward, before the first observation it is NaN
+
+        :param item_names: names of the items (columns of the arrays)
+        :type item_names: list[str]
+        :param timestamps: start of every time bucket
+        :type timestamps: np.ndarray[datetime64[m]]
+        :param prices: prices in chaos orbs (buckets x items)
+        :type prices: np.ndarray[float64]
+        :param liquidity: liquidity from 0 to 5 (buckets x items)
+        :type liquidity: np.ndarray[float64]
+        """
+        self.item_names = list(item_names)
+        self.timestamps = timestamps
+        self.prices = prices
+        self.liquidity = liquidity
+
+    @classmethod
+    def from_observations(cls, names, dates, prices, liquidity, bucket_minutes=BUCKET_MINUTES):
+        """
+        Aligns raw observations (one per item update) on time buckets
+
+        :param names: item name of every observation
+        :type names: list[str]
+        :param dates: time of every observation
+        :type dates: np.ndarray[datetime64]
+        :param prices: price of every observation
+        :type prices: np.ndarray[float64]
+        :param liquidity: liquidity of every observation
+        :type liquidity: np.ndarray[float64]
+        :param bucket_minutes: width of a time bucket in minutes
+        :type bucket_minutes: int
+        :return: aligned history
+        :rtype: PriceHistory
+        """
+        # Number the items in order of appearance (much faster than sorting the strings), then by name
+        first_seen = {}
+        item_column = np.fromiter((first_seen.setdefault(name, len(first_seen)) for name in names), dtype=np.intp, count=len(names))
+        if not first_seen:
+            return cls([], np.array([], dtype='datetime64[m]'), np.empty((0, 0)), np.empty((0, 0)))
+        item_names = sorted(first_seen)
+        rank = np.empty(len(item_names), dtype=np.intp)
+        rank[[first_seen[name] for name in item_names]] = np.arange(len(item_names))
+        item_column = rank[item_column]
+
+        minutes = dates.astype('datetime64[m]').astype(np.int64)
+        start = minutes.min() // bucket_minutes * bucket_minutes
+        offset = minutes - start
+        bucket = offset // bucket_minutes
+        num_buckets = int(bucket.max()) + 1
+
+        # Keep only the latest observation of every item in every bucket (single sort on a combined integer key)
+        cell = bucket * len(item_names) + item_column
+        order = np.argsort(cell * (int(offset.max()) + 1) + offset)
+        cell = cell[order]
+        last = order[np.append(cell[1:] != cell[:-1], True)]
+
+        aligned_prices = np.full((num_buckets, len(item_names)), np.nan)
+        aligned_liquidity = np.full((num_buckets, len(item_names)), np.nan)
+        aligned_prices[bucket[last], item_column[last]] = prices[last]
+        aligned_liquidity[bucket[last], item_column[last]] = liquidity[last]
+
+        # Carry the last observation forward
+        source_row = np.where(np.isnan(aligned_prices), 0, np.arange(num_buckets)[:, None])
+        np.maximum.accumulate(source_row, axis=0, out=source_row)
+        columns = np.arange(len(item_names))[None, :]
+        aligned_prices = aligned_prices[source_row, columns]
+        aligned_liquidity = aligned_liquidity[source_row, columns]
+
+        timestamps = (start + np.arange(num_buckets) * bucket_minutes).astype('datetime64[m]')
+        return cls(item_names, timestamps, aligned_prices, aligned_liquidity)
+
+    @classmethod
+    def from_database(cls, league, database='item_database.db', since=None, bucket_minutes=BUCKET_MINUTES):
+        """
+        Loads the history of all items of the league from the database
+
+        :param league: name of the league
+        :type league: str
+        :param database: path to the database
+        :type database: str
+        :param since: ignore observations older than this
+        :type since: datetime
+        :param bucket_minutes: width of a time bucket in minutes
+        :type bucket_minutes: int
+        :return: aligned history
+        :rtype: PriceHistory
+        """
+        since = (since or datetime.min).strftime("%Y-%m-%dT%H:%M:%SZ")
+        with sqlite3.connect(database) as connection:
+            # Databases that never recorded the history don't have the table yet
+            create_tables(connection.cursor())
+            rows = connection.execute("""SELECT name, price, liquidity, date_checked FROM item_history
+                                         WHERE league=:league AND date_checked>=:since AND price>0""",
+                                      {'league': league, 'since': since}).fetchall()
+
+        if rows:
+            names, prices, liquidity, dates = zip(*rows)
+        else:
+            names, prices, liquidity, dates = (), (), (), ()
+        return cls.from_observations(names,
+                                     np.array([date.rstrip('Z') for date in dates], dtype='datetime64[s]'),
+                                     np.array(prices, dtype=np.float64),
+                                     np.array(liquidity, dtype=np.float64),
+                                     bucket_minutes)
+
+    def with_items(self, item_names):
+        """
+        Adds empty (all NaN) columns for the items that have no history
+
+        :param item_names: names of the items that must be present
+        :type item_names: list[str]
+        :return: history with all the requested items
+        :rtype: PriceHistory
+        """
+        known = set(self.item_names)
+        missing = sorted(set(item_names) - known)
+        if not missing:
+            return self
+        empty = np.full((len(self.timestamps), len(missing)), np.nan)
+        return PriceHistory(self.item_names + missing, self.timestamps,
+                            np.hstack([self.prices, empty]), np.hstack([self.liquidity, empty]))
+
+
+class BacktestReport:
+
+    def __init__(self, recipe_names, timestamps, cost, revenue, min_liquidity):
+        """
+        Cost, revenue, profit and ROI of every recipe at every time bucket, with per-recipe statistics
+        Buckets in which any item of the recipe had no known price are NaN and are left out of the statistics
+
+        :param recipe_names: names of the recipes (rows of the arrays)
+        :type recipe_names: list[str]
+        :param timestamps: start of every time bucket
+        :type timestamps: np.ndarray[datetime64[m]]
+        :param cost: cost of the components (recipes x buckets)
+        :type cost: np.ndarray[float64]
+        :param revenue: value of the results (recipes x buckets)
+        :type revenue: np.ndarray[float64]
+        :param min_liquidity: liquidity of the least liquid item of the recipe, NaN if any item had no data (recipes x buckets)
+        :type min_liquidity: np.ndarray[float64]
+        """
+        self.recipe_names = recipe_names
+        self.timestamps = timestamps
+        self.cost = cost
+        self.revenue = revenue
+        self.min_liquidity = min_liquidity
+
+        self.profit = revenue - cost
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.roi = np.where(cost > 0, 100 * self.profit / cost, np.where(np.isnan(cost), np.nan, 0))
+
+        valid = ~np.isnan(self.profit)
+        self.observed = valid.sum(axis=1)
+        observed = np.maximum(self.observed, 1)
+        has_data = self.observed > 0
+
+        # Statistics of the profit distribution
+        filled = np.where(valid, self.profit, 0)
+        self.mean_profit = np.where(has_data, filled.sum(axis=1) / observed, np.nan)
+        deviation = np.where(valid, self.profit - self.mean_profit[:, None], 0)
+        self.std_profit = np.where(has_data, np.sqrt((deviation ** 2).sum(axis=1) / observed), np.nan)
+        self.mean_roi = np.where(has_data, np.where(valid, self.roi, 0).sum(axis=1) / observed, np.nan)
+        self.hit_rate = np.where(has_data, (filled > 0).sum(axis=1) / observed, np.nan)
+
+        # Hit rate over the buckets in which the whole recipe could actually be traded
+        liquid = valid & (np.nan_to_num(min_liquidity, nan=-1) >= LIQUID_MIN_LIQUIDITY)
+        self.liquid_observed = liquid.sum(axis=1)
+        self.liquid_hit_rate = np.where(self.liquid_observed > 0,
+                                        (liquid & (filled > 0)).sum(axis=1) / np.maximum(self.liquid_observed, 1), np.nan)
+
+        # Percentiles: sort every row once (NaN goes last) and interpolate between the observed values
+        ordered = np.sort(self.profit, axis=1)
+        rows = np.arange(len(recipe_names))
+        percentiles = []
+        for q in (5, 50, 95):
+            position = (observed - 1) * q / 100
+            lower = np.floor(position).astype(np.intp)
+            upper = np.minimum(lower + 1, observed - 1)
+            weight = position - lower
+            if len(timestamps):
+                value = ordered[rows, lower] * (1 - weight) + ordered[rows, upper] * weight
+            else:
+                value = np.zeros(len(recipe_names))
+            percentiles.append(np.where(has_data, value, np.nan))
+        self.profit_p5, self.median_profit, self.profit_p95 = percentiles
+
+        # Largest drop of the profit from its previous peak
+        peak = np.fmax.accumulate(self.profit, axis=1) if len(timestamps) else self.profit
+        self.max_drawdown = np.where(has_data, np.where(valid, peak - self.profit, 0).max(axis=1, initial=0), np.nan)
+
+    def summary(self, sort_by='hit_rate'):
+        """
+        Per-recipe statistics as rows
+
+        :param sort_by: statistic used to sort the rows (descending, recipes without data last)
+        :type sort_by: str
+        :return: one dictionary per recipe
+        :rtype: list[dict]
+        """
+        columns = ['observed', 'hit_rate', 'liquid_observed', 'liquid_hit_rate', 'mean_profit', 'std_profit', 'median_profit', 'profit_p5', 'profit_p95',
+                   'mean_roi', 'max_drawdown']
+        values = [getattr(self, column).tolist() for column in columns]
+        rows = [dict(zip(['name'] + columns, row)) for row in zip(self.recipe_names, *values)]
+        rows.sort(key=lambda x: (np.isnan(x[sort_by]), -np.nan_to_num(x[sort_by])))
+        return rows
+
+
+def backtest(history, definitions):
+    """
+    Evaluates every recipe at every time bucket of the history in a single vectorized pass
+
+    :param history: aligned price history
+    :type history: PriceHistory
+    :param definitions: recipe definitions (see recipe.load_recipe_definitions)
+    :type definitions: list[dict]
+    :return: backtest report
+    :rtype: BacktestReport
+    """
+    recipe_items = [entry[0] for definition in definitions for entry in definition['components'] + definition['results']]
+    history = history.with_items(recipe_items)
+    component_index, component_count, result_index, result_count = build_recipe_arrays(definitions, history.item_names)
+
+    # Items as rows (gathering rows is much faster than columns), extra row for padding entries: price 0, best liquidity
+    num_buckets = len(history.timestamps)
+    prices = np.vstack([history.prices.T, np.zeros((1, num_buckets))])
+    liquidity = np.vstack([history.liquidity.T, np.full((1, num_buckets), 5.0)])
+
+    def total(index, count):
+        # Loop over the (few) entries of a recipe, every step is vectorized over recipes and buckets
+        value = np.zeros((len(definitions), num_buckets))
+        for k in range(index.shape[1]):
+            value += prices[index[:, k]] * count[:, k, None]
+        return value
+
+    cost = total(component_index, component_count)
+    revenue = total(result_index, result_count)
+
+    # np.minimum keeps NaN, an item without data makes the liquidity of the recipe unknown
+    min_liquidity = np.full((len(definitions), num_buckets), 5.0)
+    for index in (component_index, result_index):
+        for k in range(index.shape[1]):
+            np.minimum(min_liquidity, liquidity[index[:, k]], out=min_liquidity)
+
+    return BacktestReport([definition['name'] for definition in definitions], history.timestamps, cost, revenue, min_liquidity)
+
+
+def benchmark(num_recipes=5000, num_items=2000, days=90, updates_per_item_per_day=24, seed=0):
+    """
+    Times the backtest over synthetic data of a full league (prints the results)
+
+    :param num_recipes: number of generated recipes
+    :type num_recipes: int
+    :param num_items: number of generated items
+    :type num_items: int
+    :param days: length of the history in days
+    :type days: int
+    :param updates_per_item_per_day: how often every item is refreshed
+    :type updates_per_item_per_day: int
+    :param seed: seed of the random generator
+    :type seed: int
+    """
+    rng = np.random.default_rng(seed)
+    item_names = np.array([f"item_{i}" for i in range(num_items)])
+
+    num_observations = num_items * days * updates_per_item_per_day
+    names = item_names[rng.integers(0, num_items, num_observations)]
+    dates = np.datetime64('2021-01-01T00:00') + rng.integers(0, days * 24 * 60, num_observations).astype('timedelta64[m]')
+    prices = np.ceil(rng.lognormal(3, 1.5, num_observations))
+    liquidity = rng.integers(0, 6, num_observations).astype(np.float64)
+
+    definitions = []
+    for i in range(num_recipes):
+        picked = rng.choice(item_names, rng.integers(2, 6), replace=False)
+        definitions.append({'name': f"recipe_{i}",
+                            'components': [[name, 1] for name in picked[1:]],
+                            'results': [[picked[0], 1]]})
+
+    start = time.perf_counter()
+    history = PriceHistory.from_observations(names, dates, prices, liquidity)
+    aligned = time.perf_counter()
+    report = backtest(history, definitions)
+    evaluated = time.perf_counter()
+    report.summary()
+    summarized = time.perf_counter()
+
+    print(f"{num_observations} observations of {num_items} items over {days} days -> {len(history.timestamps)} buckets")
+    print(f"{'Aligning history':<30}{aligned - start:>8.3f} s")
+    print(f"{'Evaluating ' + str(num_recipes) + ' recipes':<30}{evaluated - aligned:>8.3f} s")
+    print(f"{'Summarizing':<30}{summarized - evaluated:>8.3f} s")
+    print(f"{'Total':<30}{summarized - start:>8.3f} s")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        benchmark()
+    else:
+        league = sys.argv[1] if len(sys.argv) > 1 else 'Ritual'
+        report = backtest(PriceHistory.from_database(league), load_recipe_definitions())
+        print(f"{'Recipe':<45}{'Buckets':>8}{'Hit rate':>10}{'Liquid':>10}{'Mean':>10}{'P5':>10}{'Median':>10}{'P95':>10}{'Drawdown':>10}")
+        for row in report.summary():
+            print(f"{row['name']:<45}{row['observed']:>8}{row['hit_rate']:>10.1%}{row['liquid_hit_rate']:>10.1%}{row['mean_profit']:>10.1f}"
+                  f"{row['profit_p5']:>10.1f}{row['median_profit']:>10.1f}{row['profit_p95']:>10.1f}{row['max_drawdown']:>10.1f}")
@@ -0,0 +1,195 @@
+import time
+import queue
+import warnings
+import sqlite3
+import threading
+from item import create_tables, write_record, write_history
+
+BATCH_SIZE = 500
+FLUSH_SECONDS = 1.0
+# Other processes may hold the write lock for a while (the wait is per statement)
+LOCK_TIMEOUT_SECONDS = 60
+# A failed batch is kept and retried with a growing delay, on close it is only retried a few times
+RETRY_SECONDS = 1.0
+MAX_RETRY_SECONDS = 60.0
+CLOSE_ATTEMPTS = 5
+
+
+class DatabaseWriter:
+
+    def __init__(self, database='item_database.db', batch_size=BATCH_SIZE, flush_seconds=FLUSH_SECONDS, on_commit=None):
+        """
+        Background writer that owns its own database connection and commits item updates in batches
+        Updates can be submitted from any thread, repeated updates of the same item are merged before they are written
+
+        :param database: path to the database
+        :type database: str
+        :param batch_size: number of distinct items that triggers a commit
+        :type batch_size: int
+        :param flush_seconds: longest time an update waits before it is committed
+        :type flush_seconds: float
+        :param on_commit: called (from the writer thread) after every committed batch
+        :type on_commit: callable
+        """
+        self.database = database
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.on_commit = on_commit
+
+        self._updates = queue.Queue()
+        self._committed = []
+        self._committed_lock = threading.Lock()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='DatabaseWriter', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, item):
+        """
+        Queues the current values of the item, never waits for the disk
+
+        :param item: item to write
+        :type item: item.Item
+        """
+        self._raise_if_stopped()
+        self._updates.put(item.database_record())
+
+    def committed(self):
+        """
+        Items whose update was committed (after on_commit returned) since the last call
+
+        :return: names and leagues of the items
+        :rtype: list[tuple[str, str]]
+        """
+        with self._committed_lock:
+            committed, self._committed = self._committed, []
+        return committed
+
+    def flush(self):
+        """
+        Blocks until everything submitted so far is committed (a batch that can't be committed yet is retried)
+
+        :raises RuntimeError: if the writer is closed or stopped because of an error
+        """
+        self._raise_if_stopped()
+        done = threading.Event()
+        self._updates.put(done)
+        while not done.wait(0.1):
+            self._raise_if_stopped()
+
+    def close(self):
+        """
+        Commits everything submitted so far with a full sync to the disk and stops the writer
+        """
+        if self._thread.is_alive():
+            self._updates.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError("The database writer stopped because of an error") from self._error
+
+    def _raise_if_stopped(self):
+        self._raise_error()
+        if not self._thread.is_alive():
+            raise RuntimeError("The database writer is closed")
+
+    def _run(self):
+        connection = sqlite3.connect(self.database, timeout=LOCK_TIMEOUT_SECONDS)
+        try:
+            # Batches are synced lazily (WAL), everything is synced fully on close
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            create_tables(connection.cursor())
+
+            latest = {}
+            superseded = []
+            waiting = []
+            deadline = None
+            retry_at = None
+            failures = 0
+            stopping = False
+            while True:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    update = self._updates.get(timeout=timeout)
+                except queue.Empty:
+                    update = False
+
+                if update is None:
+                    stopping = True
+                elif isinstance(update, threading.Event):
+                    waiting.append(update)
+                elif update:
+                    # The newest valid values of an item win, but every valid observation goes to the history
+                    key = (update['name'], update['league'])
+                    if update['price'] != 0:
+                        if key in latest and latest[key]['price'] != 0:
+                            superseded.append(latest[key])
+                        latest[key] = update
+                    elif key not in latest:
+                        latest[key] = update
+                    if deadline is None:
+                        deadline = time.monotonic() + self.flush_seconds
+
+                now = time.monotonic()
+                due = stopping or waiting or len(latest) >= self.batch_size or (deadline is not None and now >= deadline)
+                if not due or (retry_at is not None and now < retry_at):
+                    continue
+
+                if latest:
+                    try:
+                        self._commit(connection, latest, superseded)
+                    except sqlite3.OperationalError as e:
+                        # E.g. the database stayed locked by another process, keep the batch and try again later
+                        failures += 1
+                        if stopping and failures >= CLOSE_ATTEMPTS:
+                            raise
+                        delay = min(RETRY_SECONDS * 2 ** (failures - 1), MAX_RETRY_SECONDS)
+                        warnings.warn(f"Committing {len(latest)} items failed, retrying in {delay:g} s -- Reason: {e!r}",
+                                      category=RuntimeWarning)
+                        retry_at = deadline = now + delay
+                        continue
+                    latest = {}
+                    superseded = []
+                    failures = 0
+                    retry_at = None
+                deadline = None
+                for done in waiting:
+                    done.set()
+                waiting = []
+                if stopping:
+                    break
+
+            # Earlier batches weren't synced, move everything from the WAL into the database with full syncs
+            connection.execute("PRAGMA synchronous=FULL")
+            busy, _, _ = connection.execute("PRAGMA wal_checkpoint(FULL)").fetchone()
+            if busy:
+                warnings.warn("The database was busy, the last updates are only synced in the write-ahead log", category=RuntimeWarning)
+        except BaseException as e:
+            self._error = e
+        finally:
+            connection.close()
+
+    def _commit(self, connection, updates, superseded):
+        with connection:
+            cursor = connection.cursor()
+            status = [write_record(cursor, item_dict) for item_dict in updates.values()]
+            # Older valid observations of the same items, merged into the latest ones
+            write_history(cursor, superseded)
+        print(f"{status.count('updated')} items were updated and {status.count('added')} added to the database")
+
+        if self.on_commit is not None:
+            try:
+                self.on_commit()
+            except Exception as e:
+                warnings.warn(f"Callback after the database commit failed -- Reason: {e!r}", category=RuntimeWarning)
+
+        with self._committed_lock:
+            self._committed.extend(updates)
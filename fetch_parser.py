@@ -0,0 +1,99 @@
+import json
+import numpy as np
+
+# Fastest available decoder: a fast full parser (fastest by far), then a streaming C parser that only builds the listings
+# (lowest memory), then the standard library
+try:
+    import orjson
+    JSON_BACKEND = 'orjson'
+except ImportError:
+    try:
+        import ijson
+        if ijson.backend not in ('yajl2_c', 'yajl2_cffi'):
+            raise ImportError("only the pure python backend of ijson is available")
+        JSON_BACKEND = 'ijson'
+    except ImportError:
+        JSON_BACKEND = 'json'
+
+# The only fields of a fetched offer that pricing needs
+OFFER_DTYPE = np.dtype([('amount', 'f8'),
+                        ('currency', 'U16'),
+                        ('indexed', 'datetime64[s]')])
+
+CHUNK_SIZE = 16 * 1024
+
+
+class _ChunkReader:
+
+    def __init__(self, chunks):
+        """
+        File-like view of an iterator of byte chunks (what the streaming parser reads from)
+
+        :param chunks: chunks of the body
+        :type chunks: iterator[bytes]
+        """
+        self._chunks = chunks
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _records_to_array(records):
+    if not records:
+        return np.empty(0, dtype=OFFER_DTYPE)
+    return np.array([(amount, currency, indexed.rstrip('Z')) for amount, currency, indexed in records], dtype=OFFER_DTYPE)
+
+
+def _stream_offers(stream):
+    """
+    Streams the body and builds only the listing of every offer (the parser skips the rest of the item)
+    """
+    records = []
+    for listing in ijson.items(stream, 'result.item.listing', use_float=True):
+        listing = listing or {}
+        price = listing.get('price') or {}
+        if price.get('amount') is not None and listing.get('indexed') is not None:
+            records.append((price['amount'], price.get('currency') or '', listing['indexed']))
+    return _records_to_array(records)
+
+
+def _prune_offers(data):
+    """
+    Keeps only the price and the listing time of every offer of a decoded response
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('result'), list):
+        return _records_to_array([])
+    records = []
+    for offer in data['result']:
+        listing = (offer or {}).get('listing') or {}
+        price = listing.get('price') or {}
+        if price.get('amount') is not None and listing.get('indexed') is not None:
+            records.append((price['amount'], price.get('currency') or '', listing['indexed']))
+    return _records_to_array(records)
+
+
+def parse_fetch_response(response):
+    """
+    Decodes the response of the trade api '/fetch' endpoint into a compact array of offers
+    The response should be requested with stream=True, so that the streaming backend never holds the whole body
+
+    :param response: response of the fetch request
+    :type response: requests.Response
+    :return: amount, currency and listing time of every offer (skipping offers without a price), empty if the response
+             has no offers (e.g. an error)
+    :rtype: np.ndarray[OFFER_DTYPE]
+    """
+    if JSON_BACKEND == 'orjson':
+        return _prune_offers(orjson.loads(response.content))
+    if JSON_BACKEND == 'ijson':
+        return _stream_offers(_ChunkReader(response.iter_content(CHUNK_SIZE)))
+    return _prune_offers(json.loads(response.content))
@@ -1,10 +1,31 @@
+import os
+import warnings
 import xlsxwriter
 import yaml
 from recipe import Recipe
+from risk import evaluate_recipes
+from snapshot import PriceSnapshot, SNAPSHOT_PATH
 yaml.warnings({'YAMLLoadWarning': False})
 
 
 def generate_excel():
+    # Read prices from the shared snapshot when the refresher has published one
+    snapshot = None
+    if os.path.exists(SNAPSHOT_PATH):
+        try:
+            snapshot = PriceSnapshot()
+        except EnvironmentError as e:
+            # E.g. left over by an older version, the next publish replaces it
+            warnings.warn(f"Cannot read the price snapshot, prices are read from the database -- Reason: {e}", category=RuntimeWarning)
+    try:
+        write_workbook(snapshot)
+    finally:
+        # Also when the workbook can't be written (e.g. it is open in Excel)
+        if snapshot is not None:
+            snapshot.close()
+
+
+def write_workbook(snapshot=None):
     # Read all recipes
     with open('recipes.yaml', 'r') as f:
         yaml_file = yaml.load(f)
@@ -18,7 +39,7 @@ def generate_excel():
     ######################################################################
 
     # Set columns and cells
-    worksheet_vendor.set_column("A:M", 20)
+    worksheet_vendor.set_column("A:P", 20)
     worksheet_vendor.set_row(0, 45)
     worksheet_vendor.set_row(1, 25)
 
@@ -33,7 +54,7 @@ def generate_excel():
     })
     title_format.set_align('center')
     title_format.set_align('vcenter')
-    worksheet_vendor.merge_range("A1:M1", "Vendor Recipes", title_format)
+    worksheet_vendor.merge_range("A1:P1", "Vendor Recipes", title_format)
 
     # Headers
     header_format = workbook.add_format({
@@ -50,13 +71,19 @@ def generate_excel():
     worksheet_vendor.merge_range("I2:J2", "Result", header_format)
     worksheet_vendor.write("K2", "ROI", header_format)
     worksheet_vendor.write("L2", "Profit", header_format)
-    worksheet_vendor.write("M2", "Wiki links", header_format)
+    worksheet_vendor.write("M2", "Expected Profit", header_format)
+    worksheet_vendor.write("N2", "P(loss)", header_format)
+    worksheet_vendor.write("O2", "Profit 5-95%", header_format)
+    worksheet_vendor.write("P2", "Wiki links", header_format)
 
     # Load all recipes
     recipes = []
     for recipe_yaml in yaml_file['vendor_recipes']:
         current_recipe = yaml_file['vendor_recipes'][recipe_yaml]
-        recipes.append(Recipe(recipe_yaml, 'Ritual', current_recipe['components'], current_recipe['results'], current_recipe['wiki']))
+        recipes.append(Recipe(recipe_yaml, 'Ritual', current_recipe['components'], current_recipe['results'], current_recipe['wiki'], snapshot))
+
+    # Simulate the profit under price uncertainty
+    evaluate_recipes(recipes)
 
     # Sort recipes descending by profit
     recipes.sort(key=lambda x: x.profit, reverse=True)
@@ -131,8 +158,20 @@ def generate_excel():
         col = 11
         worksheet_vendor.merge_range(row, col, row + 1, col, recipe.profit, numbers_format)
 
-        # Wiki
+        # Expected profit
         col = 12
+        worksheet_vendor.merge_range(row, col, row + 1, col, round(recipe.expected_profit, 1), numbers_format)
+
+        # Probability of a loss
+        col = 13
+        worksheet_vendor.merge_range(row, col, row + 1, col, f"{round(100 * recipe.loss_probability, 1)} %", numbers_format)
+
+        # Profit band (5th to 95th percentile)
+        col = 14
+        worksheet_vendor.merge_range(row, col, row + 1, col, f"{round(recipe.profit_p5)} to {round(recipe.profit_p95)}", numbers_format)
+
+        # Wiki
+        col = 15
         worksheet_vendor.merge_range(row, col, row + 1, col, "placeholder", numbers_format)
         worksheet_vendor.write_url(row, col, recipe.wiki, numbers_format, "Wiki Link")
 
@@ -147,12 +186,12 @@ def generate_excel():
     worksheet_harbinger = workbook.add_worksheet("Harbinger Upgrades")
 
     # Format columns and rows
-    worksheet_harbinger.set_column("A:I", 20)
+    worksheet_harbinger.set_column("A:L", 20)
     worksheet_harbinger.set_row(0, 45)
     worksheet_harbinger.set_row(1, 25)
 
     # Title
-    worksheet_harbinger.merge_range("A1:I1", "Harbinger Upgrades", title_format)
+    worksheet_harbinger.merge_range("A1:L1", "Harbinger Upgrades", title_format)
 
     # Headers
     worksheet_harbinger.merge_range("A2:B2", "Item", header_format)
@@ -160,13 +199,19 @@ def generate_excel():
     worksheet_harbinger.merge_range("E2:F2", "Result", header_format)
     worksheet_harbinger.write("G2", "ROI", header_format)
     worksheet_harbinger.write("H2", "Profit", header_format)
-    worksheet_harbinger.write("I2", "Wiki links", header_format)
+    worksheet_harbinger.write("I2", "Expected Profit", header_format)
+    worksheet_harbinger.write("J2", "P(loss)", header_format)
+    worksheet_harbinger.write("K2", "Profit 5-95%", header_format)
+    worksheet_harbinger.write("L2", "Wiki links", header_format)
 
     # Load all recipes
     recipes = []
     for recipe_yaml in yaml_file['harbinger_upgrades']:
         current_recipe = yaml_file['harbinger_upgrades'][recipe_yaml]
-        recipes.append(Recipe(recipe_yaml, 'Ritual', current_recipe['components'], current_recipe['results'], current_recipe['wiki']))
+        recipes.append(Recipe(recipe_yaml, 'Ritual', current_recipe['components'], current_recipe['results'], current_recipe['wiki'], snapshot))
+
+    # Simulate the profit under price uncertainty
+    evaluate_recipes(recipes)
 
     # Sort recipes descending by profit
     recipes.sort(key=lambda x: x.profit, reverse=True)
@@ -217,8 +262,20 @@ def generate_excel():
         col = 7
         worksheet_harbinger.merge_range(row, col, row + 1, col, recipe.profit, numbers_format)
 
-        # Wiki
+        # Expected profit
         col = 8
+        worksheet_harbinger.merge_range(row, col, row + 1, col, round(recipe.expected_profit, 1), numbers_format)
+
+        # Probability of a loss
+        col = 9
+        worksheet_harbinger.merge_range(row, col, row + 1, col, f"{round(100 * recipe.loss_probability, 1)} %", numbers_format)
+
+        # Profit band (5th to 95th percentile)
+        col = 10
+        worksheet_harbinger.merge_range(row, col, row + 1, col, f"{round(recipe.profit_p5)} to {round(recipe.profit_p95)}", numbers_format)
+
+        # Wiki
+        col = 11
         worksheet_harbinger.merge_range(row, col, row + 1, col, "placeholder", numbers_format)
         worksheet_harbinger.write_url(row, col, recipe.wiki, numbers_format, "Wiki Link")
 
@@ -233,12 +290,12 @@ def generate_excel():
     worksheet_vials = workbook.add_worksheet("Vial Uniques")
 
     # Format columns and rows
-    worksheet_vials.set_column("A:I", 20)
+    worksheet_vials.set_column("A:L", 20)
     worksheet_vials.set_row(0, 45)
     worksheet_vials.set_row(1, 25)
 
     # Title
-    worksheet_vials.merge_range("A1:I1", "Vial Uniques", title_format)
+    worksheet_vials.merge_range("A1:L1", "Vial Uniques", title_format)
 
     # Headers
     worksheet_vials.merge_range("A2:B2", "Item", header_format)
@@ -246,13 +303,19 @@ def generate_excel():
     worksheet_vials.merge_range("E2:F2", "Result", header_format)
     worksheet_vials.write("G2", "ROI", header_format)
     worksheet_vials.write("H2", "Profit", header_format)
-    worksheet_vials.write("I2", "Wiki links", header_format)
+    worksheet_vials.write("I2", "Expected Profit", header_format)
+    worksheet_vials.write("J2", "P(loss)", header_format)
+    worksheet_vials.write("K2", "Profit 5-95%", header_format)
+    worksheet_vials.write("L2", "Wiki links", header_format)
 
     # Load all recipes
     recipes = []
     for recipe_yaml in yaml_file['vial_uniques']:
         current_recipe = yaml_file['vial_uniques'][recipe_yaml]
-        recipes.append(Recipe(recipe_yaml, 'Ritual', current_recipe['components'], current_recipe['results'], current_recipe['wiki']))
+        recipes.append(Recipe(recipe_yaml, 'Ritual', current_recipe['components'], current_recipe['results'], current_recipe['wiki'], snapshot))
+
+    # Simulate the profit under price uncertainty
+    evaluate_recipes(recipes)
 
     # Sort recipes descending by profit
     recipes.sort(key=lambda x: x.profit, reverse=True)
@@ -303,8 +366,20 @@ def generate_excel():
         col = 7
         worksheet_vials.merge_range(row, col, row + 1, col, recipe.profit, numbers_format)
 
-        # Wiki
+        # Expected profit
         col = 8
+        worksheet_vials.merge_range(row, col, row + 1, col, round(recipe.expected_profit, 1), numbers_format)
+
+        # Probability of a loss
+        col = 9
+        worksheet_vials.merge_range(row, col, row + 1, col, f"{round(100 * recipe.loss_probability, 1)} %", numbers_format)
+
+        # Profit band (5th to 95th percentile)
+        col = 10
+        worksheet_vials.merge_range(row, col, row + 1, col, f"{round(recipe.profit_p5)} to {round(recipe.profit_p95)}", numbers_format)
+
+        # Wiki
+        col = 11
         worksheet_vials.merge_range(row, col, row + 1, col, "placeholder", numbers_format)
         worksheet_vials.write_url(row, col, recipe.wiki, numbers_format, "Wiki Link")
 
@@ -319,12 +394,12 @@ def generate_excel():
     worksheet_blessings = workbook.add_worksheet("Blessing Upgrades")
 
     # Format columns and rows
-    worksheet_blessings.set_column("A:I", 20)
+    worksheet_blessings.set_column("A:L", 20)
     worksheet_blessings.set_row(0, 45)
     worksheet_blessings.set_row(1, 25)
 
     # Title
-    worksheet_blessings.merge_range("A1:I1", "Blessing Upgrades", title_format)
+    worksheet_blessings.merge_range("A1:L1", "Blessing Upgrades", title_format)
 
     # Headers
     worksheet_blessings.merge_range("A2:B2", "Item", header_format)
@@ -332,13 +407,19 @@ def generate_excel():
     worksheet_blessings.merge_range("E2:F2", "Result", header_format)
     worksheet_blessings.write("G2", "ROI", header_format)
     worksheet_blessings.write("H2", "Profit", header_format)
-    worksheet_blessings.write("I2", "Wiki links", header_format)
+    worksheet_blessings.write("I2", "Expected Profit", header_format)
+    worksheet_blessings.write("J2", "P(loss)", header_format)
+    worksheet_blessings.write("K2", "Profit 5-95%", header_format)
+    worksheet_blessings.write("L2", "Wiki links", header_format)
 
     # Load all recipes
     recipes = []
     for recipe_yaml in yaml_file['blessing_upgrades']:
         current_recipe = yaml_file['blessing_upgrades'][recipe_yaml]
-        recipes.append(Recipe(recipe_yaml, 'Ritual', current_recipe['components'], current_recipe['results'], current_recipe['wiki']))
+        recipes.append(Recipe(recipe_yaml, 'Ritual', current_recipe['components'], current_recipe['results'], current_recipe['wiki'], snapshot))
+
+    # Simulate the profit under price uncertainty
+    evaluate_recipes(recipes)
 
     # Sort recipes descending by profit
     recipes.sort(key=lambda x: x.profit, reverse=True)
@@ -389,8 +470,20 @@ def generate_excel():
         col = 7
         worksheet_blessings.merge_range(row, col, row + 1, col, recipe.profit, numbers_format)
 
-        # Wiki
+        # Expected profit
         col = 8
+        worksheet_blessings.merge_range(row, col, row + 1, col, round(recipe.expected_profit, 1), numbers_format)
+
+        # Probability of a loss
+        col = 9
+        worksheet_blessings.merge_range(row, col, row + 1, col, f"{round(100 * recipe.loss_probability, 1)} %", numbers_format)
+
+        # Profit band (5th to 95th percentile)
+        col = 10
+        worksheet_blessings.merge_range(row, col, row + 1, col, f"{round(recipe.profit_p5)} to {round(recipe.profit_p95)}", numbers_format)
+
+        # Wiki
+        col = 11
         worksheet_blessings.merge_range(row, col, row + 1, col, "placeholder", numbers_format)
         worksheet_blessings.write_url(row, col, recipe.wiki, numbers_format, "Wiki Link")
 
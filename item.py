@@ -4,8 +4,10 @@ import json
 import sqlite3
 import requests
 import warnings
+import numpy as np
 from math import ceil
 from datetime import datetime
+from fetch_parser import parse_fetch_response
 
 connection = sqlite3.connect('item_database.db')
 cursor = connection.cursor()
@@ -39,9 +41,110 @@ def add_currency_filter_to_query(query, currency):
     return query
 
 
+def minutes_since(dates):
+    """
+    Whole minutes that passed since the given times
+
+    :param dates: times in UTC
+    :type dates: np.ndarray[datetime64]
+    :return: minutes from every time until now
+    :rtype: list[int]
+    """
+    time_from_now = np.datetime64(datetime.utcnow(), 's') - dates.astype('datetime64[s]')
+    return (time_from_now.astype(np.int64) // 60).tolist()
+
+
+def offer_spread(prices):
+    """
+    Standard deviation of the offered prices
+
+    :param prices: prices of the offers (chaos orbs)
+    :type prices: list[float]
+    :return: spread of the prices, 0 if there are less than 2 offers
+    :rtype: float
+    """
+    if len(prices) < 2:
+        return 0.0
+    mean = sum(prices) / len(prices)
+    return (sum((price - mean) ** 2 for price in prices) / len(prices)) ** 0.5
+
+
+def create_tables(cursor):
+    """
+    Creates the tables of the database if they don't exist
+
+    :param cursor: cursor of the database connection
+    :type cursor: sqlite3.Cursor
+    """
+    cursor.execute("""CREATE TABLE IF NOT EXISTS items (name text,
+                                                        league text,
+                                                        price integer,
+                                                        search_id text,
+                                                        liquidity integer,
+                                                        date_checked text,
+                                                        category text,
+                                                        price_spread real)""")
+    # Databases created before the spread was recorded
+    columns = [column[1] for column in cursor.execute("PRAGMA table_info(items)").fetchall()]
+    if 'price_spread' not in columns:
+        cursor.execute("ALTER TABLE items ADD COLUMN price_spread real")
+
+    cursor.execute("""CREATE TABLE IF NOT EXISTS item_history (name text,
+                                                               league text,
+                                                               price integer,
+                                                               liquidity integer,
+                                                               date_checked text)""")
+
+
+def write_history(cursor, item_dicts):
+    """
+    Keeps valid observations of items so recipes can be backtested over time
+
+    :param cursor: cursor of the database connection
+    :type cursor: sqlite3.Cursor
+    :param item_dicts: values of the items (see Item.database_record), all with a valid price
+    :type item_dicts: list[dict]
+    """
+    cursor.executemany("INSERT INTO item_history VALUES (:name, :league, :price, :liquidity, :date_checked)", item_dicts)
+
+
+def write_record(cursor, item_dict):
+    """
+    Updates the item if it is already in the database or inserts it, and records a valid observation in the history
+    Invalid prices (0) never overwrite the existing data
+
+    :param cursor: cursor of the database connection (the caller commits)
+    :type cursor: sqlite3.Cursor
+    :param item_dict: values of the item (see Item.database_record)
+    :type item_dict: dict
+    :return: 'updated', 'added' or 'invalid' (the item is in the database but the new data was invalid)
+    :rtype: str
+    """
+    cursor.execute("""UPDATE items SET search_id=:search_id,
+                                       price=:price,
+                                       liquidity=:liquidity,
+                                       date_checked=:date_checked,
+                                       category=:category,
+                                       price_spread=:price_spread
+                      WHERE name=:name AND league=:league AND :price!=0""", item_dict)
+    if cursor.rowcount:
+        status = 'updated'
+    elif cursor.execute("SELECT 1 FROM items WHERE name=:name AND league=:league", item_dict).fetchone():
+        status = 'invalid'
+    else:
+        cursor.execute("""INSERT INTO items (name, league, price, search_id, liquidity, date_checked, category, price_spread)
+                          VALUES (:name, :league, :price, :search_id, :liquidity, :date_checked, :category, :price_spread)""",
+                       item_dict)
+        status = 'added'
+
+    if item_dict['price'] != 0:
+        write_history(cursor, [item_dict])
+    return status
+
+
 class Item:
 
-    def __init__(self, name, league, price=None, search_id=None, liquidity=None, date_checked=None, category='item'):
+    def __init__(self, name, league, price=None, search_id=None, liquidity=None, date_checked=None, category='item', price_spread=None):
         """
         Class representing an item and its economic activities (data is kept in the database, updated from official trade api)
 
@@ -59,6 +162,8 @@ class Item:
         :type date_checked: datetime
         :param category: 'item' or 'currency'
         :type category: str
+        :param price_spread: standard deviation of the fetched offers (chaos orbs)
+        :type price_spread: float
         """
         self.name = name
         self.league = league
@@ -68,6 +173,7 @@ class Item:
         self.liquidity = liquidity
         self.date_checked = date_checked
         self.category = category
+        self.price_spread = price_spread
 
     @property
     def search_link(self):
@@ -108,13 +214,13 @@ class Item:
             if 'result' not in chaos_request:
                 warnings.warn(f"The query for {self.name} (in chaos) returned an invalid response when executed\nCheck if the query is valid",
                               category=RuntimeWarning)
-                chaos_result = {}
+                chaos_offers = None
             else:
                 num_chaos_trades = min(10, len(chaos_request['result']))
                 chaos_items = ','.join(chaos_request['result'][:num_chaos_trades])
                 chaos_id = chaos_request['id']
                 chaos_result_url = f"https://www.pathofexile.com/api/trade/fetch/{chaos_items}?query={chaos_id}"
-                chaos_result = json.loads(requests.get(chaos_result_url, headers=headers).text)
+                chaos_offers = parse_fetch_response(requests.get(chaos_result_url, headers=headers, stream=True))
 
             # Request in exalted orbs
             exalted_query = add_currency_filter_to_query(copy.deepcopy(query), "exalted")
@@ -122,25 +228,22 @@ class Item:
             if 'result' not in exalted_request:
                 warnings.warn(f"The query for {self.name} (in exalted) returned an invalid response when executed\nCheck if the query is valid",
                               category=RuntimeWarning)
-                exalted_result = {}
+                exalted_offers = None
             else:
                 num_exalted_trades = min(10, len(exalted_request['result']))
                 exalted_items = ','.join(exalted_request['result'][:num_exalted_trades])
                 exalted_id = exalted_request['id']
                 exalted_result_url = f"https://www.pathofexile.com/api/trade/fetch/{exalted_items}?query={exalted_id}"
-                exalted_result = json.loads(requests.get(exalted_result_url, headers=headers).text)
+                exalted_offers = parse_fetch_response(requests.get(exalted_result_url, headers=headers, stream=True))
 
             # Calculate the price and liquidity
             # Chaos
             chaos_price = 0
             chaos_liquidity = 0
-            if 'result' in chaos_result:
-                chaos_prices = []
-                chaos_times = []
-                for chaos_offer in chaos_result['result']:
-                    chaos_prices.append(chaos_offer["listing"]["price"]["amount"])
-                    time_from_now = datetime.utcnow() - datetime.strptime(chaos_offer["listing"]["indexed"], "%Y-%m-%dT%H:%M:%SZ")
-                    chaos_times.append(int(time_from_now.total_seconds() / 60))
+            chaos_prices = []
+            if chaos_offers is not None and len(chaos_offers):
+                chaos_prices = chaos_offers['amount'].tolist()
+                chaos_times = minutes_since(chaos_offers['indexed'])
 
                 # Chaos price = avg(avg, median)
                 mean = sum(chaos_prices) / len(chaos_prices)
@@ -153,17 +256,14 @@ class Item:
             # Exalted
             exalted_price = 0
             exalted_liquidity = 0
-            if 'result' in exalted_result:
-                exalted_prices = []
-                exalted_times = []
-                for exalted_offer in exalted_result['result']:
-                    with connection:
-                        cursor.execute("SELECT price FROM items WHERE name='chaos_in_exalt'")
-                    exalted_rate = cursor.fetchone()[0]
-
-                    exalted_prices.append(exalted_offer["listing"]["price"]["amount"] * exalted_rate)
-                    time_from_now = datetime.utcnow() - datetime.strptime(exalted_offer["listing"]["indexed"], "%Y-%m-%dT%H:%M:%SZ")
-                    exalted_times.append(int(time_from_now.total_seconds() / 60))
+            exalted_prices = []
+            if exalted_offers is not None and len(exalted_offers):
+                with connection:
+                    cursor.execute("SELECT price FROM items WHERE name='chaos_in_exalt'")
+                exalted_rate = cursor.fetchone()[0]
+
+                exalted_prices = (exalted_offers['amount'] * exalted_rate).tolist()
+                exalted_times = minutes_since(exalted_offers['indexed'])
 
                 # Exalted price = avg(avg, median)
                 mean = sum(exalted_prices) / len(exalted_prices)
@@ -174,6 +274,9 @@ class Item:
                 exalted_time = (int(sum(exalted_times) / len(exalted_times)) + exalted_time_median) / 2.0
                 exalted_liquidity = 5 - min(5, int(exalted_time / (WORST_LIQUIDITY_IN_DAYS * 24 * 60 / 5)))
 
+            # The spread is taken from the offers that set the price, so it's relative to the same sample
+            price_offers = chaos_prices if chaos_price != 0 else exalted_prices
+
             if chaos_price == 0:
                 chaos_price = exalted_price
             chaos_price = ceil(chaos_price)
@@ -188,6 +291,7 @@ class Item:
 
             self.price = min(chaos_price, exalted_price)
             self.liquidity = max(chaos_liquidity, exalted_liquidity)
+            self.price_spread = offer_spread(price_offers)
 
             # Original request for search link generation
             request = json.loads(requests.post(url, json=query, headers=headers).text)
@@ -199,19 +303,20 @@ class Item:
                 warnings.warn(f"The query for {self.name} returned an invalid response when executed\nCheck if the query is valid", category=RuntimeWarning)
                 self.price = 0
                 self.liquidity = 0
+                self.price_spread = 0.0
             else:
                 num_trades = min(10, len(request['result']))
                 items = ','.join(request['result'][:num_trades])
                 result_url = f"https://www.pathofexile.com/api/trade/fetch/{items}?query={request['id']}"
-                result = json.loads(requests.get(result_url, headers=headers).text)
+                offers = parse_fetch_response(requests.get(result_url, headers=headers, stream=True))
 
-                if 'result' in result:
-                    prices = []
-                    for offer in result['result']:
-                        prices.append(offer["listing"]["price"]["amount"])
+                if offers is not None and len(offers):
+                    prices = offers['amount'].tolist()
                     self.price = int(prices[-1])
+                    self.price_spread = offer_spread(prices)
                 else:
                     self.price = 100
+                    self.price_spread = 0.0
 
                 self.liquidity = 5
 
@@ -223,56 +328,44 @@ class Item:
             self.search_id = request['id']
             self.date_checked = datetime.utcnow()
 
-    def dump_to_database(self):
+    def database_record(self):
+        """
+        Values of the item as stored in the database
+
+        :return: column names and values
+        :rtype: dict
+        """
+        return {'name': self.name,
+                'league': self.league,
+                'price': self.price,
+                'search_id': self.search_id,
+                'liquidity': self.liquidity,
+                'date_checked': self.date_checked.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                'category': self.category,
+                'price_spread': self.price_spread}
+
+    def dump_to_database(self, writer=None):
         """
         Dumps the data to the database
         Either updates the data if item is already present or inserts it
+
+        :param writer: if given, the update is handed to the writer instead of being written right away
+        :type writer: database_writer.DatabaseWriter
         """
-        with connection:
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='items'")
-
-        # Create table if doesn't exist
-        if not len(cursor.fetchall()):
-            cursor.execute("""CREATE TABLE items (name text,
-                                                  league text,
-                                                  price integer, 
-                                                  search_id text,
-                                                  liquidity integer,
-                                                  date_checked text,
-                                                  category text)""")
-
-        item_dict = {'name': self.name,
-                     'league': self.league,
-                     'price': self.price,
-                     'search_id': self.search_id,
-                     'liquidity': self.liquidity,
-                     'date_checked': self.date_checked.strftime("%Y-%m-%dT%H:%M:%SZ"),
-                     'category': self.category}
+        if writer is not None:
+            writer.submit(self)
+            return
 
+        create_tables(cursor)
         with connection:
-            cursor.execute("SELECT * FROM items WHERE name=:name AND league=:league", item_dict)
+            status = write_record(cursor, self.database_record())
 
-        if len(cursor.fetchall()):
-            # Update if item in database
-            if self.price == 0:
-                print(f"{self.name:<55} wasn't updated in the database -- Reason: new data was invalid")
-            else:
-                with connection:
-                    cursor.execute("""UPDATE items SET name=:name, 
-                                                       league=:league, 
-                                                       price=:price, 
-                                                       search_id=:search_id, 
-                                                       liquidity=:liquidity, 
-                                                       date_checked=:date_checked, 
-                                                       category=:category
-                                                       WHERE name=:name AND league=:league""", item_dict)
-                print(f"{self.name:<55} was updated in the database")
-        else:
-            # Insert if item not in database
-            with connection:
-                cursor.execute("INSERT INTO items VALUES (:name, :league, :price, :search_id, :liquidity, :date_checked, :category)",
-                               item_dict)
+        if status == 'updated':
+            print(f"{self.name:<55} was updated in the database")
+        elif status == 'added':
             print(f"{self.name:<55} was added to the database")
+        else:
+            print(f"{self.name:<55} wasn't updated in the database -- Reason: new data was invalid")
 
     def load_from_database(self):
         """
@@ -289,5 +382,6 @@ class Item:
             self.liquidity = select_result[0][4]
             self.date_checked = datetime.strptime(select_result[0][5], "%Y-%m-%dT%H:%M:%SZ")
             self.category = select_result[0][6]
+            self.price_spread = select_result[0][7] if len(select_result[0]) > 7 else None
         else:
             warnings.warn(f"{self.name} is not in the database", UserWarning)
@@ -5,39 +5,113 @@ import urllib3
 import requests
 import warnings
 import xlsxwriter
-from random import shuffle
 from item import Item
 from generate_excel import generate_excel
+from snapshot import publish_snapshot
+from work_queue import WorkQueue, RateLimiter, worker_name
+from database_writer import DatabaseWriter
+
+REFRESH_INTERVAL_SECONDS = 60
 
 headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36'}
 league = json.loads(requests.get("https://www.pathofexile.com/api/trade/data/leagues", headers=headers).text)['result'][0]['id']
 
 
 def main():
-    # Refresh the chaos-exalt query
-    item = Item(name='chaos_in_exalt', league=league, category='currency')
-    item.get_data_from_api()
-    item.dump_to_database()
-    time.sleep(30)
-
-    # Refresh all other queries (random order to improve consistency of the data)
-    list_of_query_files = os.listdir("search_queries")
-    shuffle(list_of_query_files)
-    for search_query_filename in list_of_query_files:
+    worker = worker_name()
+    queue = WorkQueue()
+    # Every item refresh sends a handful of requests, all workers of the host share one budget
+    rate_limiter = RateLimiter(queue, 'trade_api', interval_seconds=REFRESH_INTERVAL_SECONDS)
+
+    # Resume the unfinished pass or start a new one (random order to improve consistency of the data)
+    items = []
+    for search_query_filename in os.listdir("search_queries"):
         query_name = os.path.basename(search_query_filename).rsplit('.', 1)[0]
-        if query_name == 'chaos_in_exalt':
-            item = Item(name=query_name, league=league, category='currency')
-        else:
-            item = Item(name=query_name, league=league, category='item')
-        item.get_data_from_api()
-        item.dump_to_database()
+        items.append((query_name, 'currency' if query_name == 'chaos_in_exalt' else 'item'))
+    pass_id = queue.start_pass(league, items)
+
+    # Updates are committed in batches by the writer, readers get a fresh snapshot after every batch
+    writer = DatabaseWriter(on_commit=lambda: publish_snapshot(league))
+    try:
+        refresh_items(queue, rate_limiter, writer, pass_id, worker)
+    finally:
+        writer.close()
+        # Updates committed on close
+        acknowledge_commits(queue, writer, pass_id, worker)
+
+    print(f"Refresh pass {pass_id} finished: {queue.progress(pass_id)}")
+    queue.close()
+
+
+def refresh_items(queue, rate_limiter, writer, pass_id, worker):
+    """
+    Refreshes items of the pass until none is left
+
+    :param queue: work queue
+    :type queue: WorkQueue
+    :param rate_limiter: shared request budget
+    :type rate_limiter: RateLimiter
+    :param writer: database writer
+    :type writer: DatabaseWriter
+    :param pass_id: id of the pass
+    :type pass_id: int
+    :param worker: unique name of this worker
+    :type worker: str
+    """
+    while True:
+        acknowledge_commits(queue, writer, pass_id, worker)
+        if queue.finish_pass(pass_id):
+            break
+
+        claimed = queue.claim(pass_id, worker)
+        if claimed is None:
+            # Items of this worker may only be waiting for their commit
+            writer.flush()
+            acknowledge_commits(queue, writer, pass_id, worker)
+            if not queue.finish_pass(pass_id):
+                # Remaining items are leased by other workers or wait for a retry, leave the budget to the busy workers
+                time.sleep(REFRESH_INTERVAL_SECONDS)
+            continue
+
+        # With many workers the wait for a token can outlast the lease, start the lease over once the token is taken
+        rate_limiter.acquire()
+        query_name, category = claimed
+        if not queue.renew(pass_id, query_name, worker):
+            # Another worker took the item over in the meantime
+            continue
+        try:
+            item = Item(name=query_name, league=league, category=category)
+            item.get_data_from_api()
+            item.dump_to_database(writer)
+        except Exception as e:
+            queue.fail(pass_id, query_name, worker, repr(e))
+            warnings.warn(f"Refreshing {query_name} failed, it will be retried later -- Reason: {e!r}", category=RuntimeWarning)
+
+
+def acknowledge_commits(queue, writer, pass_id, worker):
+    """
+    Marks the items whose update is in the database as done and updates the excel file with them
+    Items are only done once committed, so a crash before the commit refreshes them again
+
+    :param queue: work queue
+    :type queue: WorkQueue
+    :param writer: database writer
+    :type writer: DatabaseWriter
+    :param pass_id: id of the pass
+    :type pass_id: int
+    :param worker: unique name of this worker
+    :type worker: str
+    """
+    committed = writer.committed()
+    for query_name, _ in committed:
+        queue.complete(pass_id, query_name, worker)
 
+    if committed:
         # Try updating excel file
         try:
             generate_excel()
         except (xlsxwriter.exceptions.FileCreateError, TypeError):
             print('Cannot update excel - close the workbook or wait until all items are downloaded!')
-        time.sleep(60)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,11 @@
+import yaml
+import numpy as np
 from item import Item
 
 
 class Recipe:
 
-    def __init__(self, name, league, components, results, wiki):
+    def __init__(self, name, league, components, results, wiki, snapshot=None):
         """
         Recipe object that uses Item objects to calculate profitability
 
@@ -17,6 +19,8 @@ class Recipe:
         :type results: list[list[str, float]]
         :param wiki: link to the game wiki
         :type wiki: str
+        :param snapshot: price snapshot to read the items from (falls back to the database)
+        :type snapshot: snapshot.PriceSnapshot
         """
         self.name = name
         self.league = league
@@ -27,7 +31,7 @@ class Recipe:
         self.components = []
         for component in components:
             item = Item(name=component[0], league=self.league)
-            item.load_from_database()
+            self._load_item(item, snapshot)
             self.cost += item.price * component[1]
             self.components.append([item, component[1]])
 
@@ -36,7 +40,7 @@ class Recipe:
         self.results = []
         for result in results:
             item = Item(name=result[0], league=self.league)
-            item.load_from_database()
+            self._load_item(item, snapshot)
             self.revenue += item.price * result[1]
             self.results.append([item, result[1]])
 
@@ -45,3 +49,76 @@ class Recipe:
             self.roi = 0
         else:
             self.roi = round(100 * self.profit / self.cost, 1)
+
+        # Profit distribution under price uncertainty, filled in by risk.evaluate_recipes
+        self.expected_profit = None
+        self.loss_probability = None
+        self.profit_p5 = None
+        self.profit_p95 = None
+
+    @staticmethod
+    def _load_item(item, snapshot):
+        """
+        Loads the item from the snapshot if it has it, from the database otherwise
+
+        :param item: item to load
+        :type item: Item
+        :param snapshot: price snapshot or None
+        :type snapshot: snapshot.PriceSnapshot
+        """
+        if snapshot is None or snapshot.league != item.league or not snapshot.load_item(item):
+            item.load_from_database()
+
+
+def load_recipe_definitions(path='recipes.yaml'):
+    """
+    Reads all recipe definitions from the yaml file
+
+    :param path: path to the yaml file with recipes
+    :type path: str
+    :return: list of recipe definitions (name, sheet, components, results, wiki)
+    :rtype: list[dict]
+    """
+    with open(path, 'r') as f:
+        yaml_file = yaml.safe_load(f)
+
+    definitions = []
+    for sheet in yaml_file:
+        for recipe_name in yaml_file[sheet]:
+            current_recipe = yaml_file[sheet][recipe_name]
+            definitions.append({'name': recipe_name,
+                                'sheet': sheet,
+                                'components': current_recipe['components'],
+                                'results': current_recipe['results'],
+                                'wiki': current_recipe['wiki']})
+    return definitions
+
+
+def build_recipe_arrays(definitions, item_names):
+    """
+    Flattens recipe definitions into padded index/count arrays, so that every recipe can be priced at once
+    Padding entries point to the column right after the last item (len(item_names)), which should hold a price of 0
+
+    :param definitions: recipe definitions (see load_recipe_definitions)
+    :type definitions: list[dict]
+    :param item_names: names of the items, their order defines the columns of the price arrays
+    :type item_names: list[str]
+    :return: component indices, component counts, result indices, result counts (each of shape recipes x max entries)
+    :rtype: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]
+    """
+    item_index = {name: i for i, name in enumerate(item_names)}
+    padding = len(item_names)
+
+    def flatten(key):
+        width = max([len(definition[key]) for definition in definitions] + [1])
+        indices = np.full((len(definitions), width), padding, dtype=np.intp)
+        counts = np.zeros((len(definitions), width), dtype=np.float64)
+        for row, definition in enumerate(definitions):
+            for col, (name, count) in enumerate(definition[key]):
+                indices[row, col] = item_index[name]
+                counts[row, col] = count
+        return indices, counts
+
+    component_index, component_count = flatten('components')
+    result_index, result_count = flatten('results')
+    return component_index, component_count, result_index, result_count
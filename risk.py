@@ -0,0 +1,142 @@
+import sys
+import time
+import numpy as np
+from recipe import Recipe, load_recipe_definitions, build_recipe_arrays
+
+SCENARIOS = 10000
+# Relative price uncertainty of an item without a recorded spread
+DEFAULT_RELATIVE_SPREAD = 0.1
+# Relative price uncertainty added to an item with the worst liquidity (0), scaled down to nothing for the best (5)
+ILLIQUIDITY_RELATIVE_SPREAD = 0.5
+
+
+def relative_uncertainty(prices, spreads, liquidity):
+    """
+    Relative uncertainty (sigma of the log price) of every item, from the spread of its offers and its liquidity
+
+    :param prices: prices of the items (chaos orbs)
+    :type prices: np.ndarray[float64]
+    :param spreads: standard deviations of the fetched offers, NaN if unknown (chaos orbs)
+    :type spreads: np.ndarray[float64]
+    :param liquidity: liquidity of the items (0 - bad, 5 - best)
+    :type liquidity: np.ndarray[float64]
+    :return: sigma of every item
+    :rtype: np.ndarray[float64]
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offer_spread = np.where(prices > 0, spreads / prices, 0)
+    offer_spread = np.where(np.isnan(offer_spread), DEFAULT_RELATIVE_SPREAD, offer_spread)
+    illiquidity = ILLIQUIDITY_RELATIVE_SPREAD * (5 - np.clip(liquidity, 0, 5)) / 5
+    return np.sqrt(offer_spread ** 2 + illiquidity ** 2)
+
+
+class RiskReport:
+
+    def __init__(self, recipe_names, profits):
+        """
+        Profit distribution of every recipe over the simulated scenarios
+
+        :param recipe_names: names of the recipes (rows of the profits)
+        :type recipe_names: list[str]
+        :param profits: profit of every recipe in every scenario (recipes x scenarios)
+        :type profits: np.ndarray[float64]
+        """
+        self.recipe_names = recipe_names
+        self.profits = profits
+
+        self.expected_profit = profits.mean(axis=1)
+        self.loss_probability = (profits < 0).mean(axis=1)
+        self.profit_p5, self.profit_p50, self.profit_p95 = np.percentile(profits, [5, 50, 95], axis=1)
+
+
+def simulate(definitions, item_names, prices, spreads, liquidity, scenarios=SCENARIOS, seed=0):
+    """
+    Samples every item price as a lognormal distribution around its current price (same mean) and prices all recipes
+    in every scenario at once. Recipes sharing an item see the same sampled price of it in a scenario
+
+    :param definitions: recipe definitions (see recipe.load_recipe_definitions)
+    :type definitions: list[dict]
+    :param item_names: names of the items
+    :type item_names: list[str]
+    :param prices: prices of the items (chaos orbs)
+    :type prices: np.ndarray[float64]
+    :param spreads: standard deviations of the fetched offers, NaN if unknown (chaos orbs)
+    :type spreads: np.ndarray[float64]
+    :param liquidity: liquidity of the items
+    :type liquidity: np.ndarray[float64]
+    :param scenarios: number of simulated scenarios
+    :type scenarios: int
+    :param seed: seed of the random generator (a fixed seed keeps the report stable between refreshes)
+    :type seed: int
+    :return: risk report
+    :rtype: RiskReport
+    """
+    component_index, component_count, result_index, result_count = build_recipe_arrays(definitions, item_names)
+
+    # Items as rows, extra row with price 0 for padding entries
+    rng = np.random.default_rng(seed)
+    sigma = relative_uncertainty(prices, spreads, liquidity)[:, None]
+    sampled = np.empty((len(item_names) + 1, scenarios))
+    np.exp(sigma * rng.standard_normal((len(item_names), scenarios), dtype=np.float64) - sigma ** 2 / 2, out=sampled[:-1])
+    sampled[:-1] *= prices[:, None]
+    sampled[-1] = 0
+
+    profits = np.zeros((len(definitions), scenarios))
+    for k in range(result_index.shape[1]):
+        profits += sampled[result_index[:, k]] * result_count[:, k, None]
+    for k in range(component_index.shape[1]):
+        profits -= sampled[component_index[:, k]] * component_count[:, k, None]
+
+    return RiskReport([definition['name'] for definition in definitions], profits)
+
+
+def evaluate_recipes(recipes, scenarios=SCENARIOS, seed=0):
+    """
+    Adds expected_profit, loss_probability, profit_p5 and profit_p95 to the recipes, using their loaded items
+
+    :param recipes: recipes to evaluate
+    :type recipes: list[Recipe]
+    :param scenarios: number of simulated scenarios
+    :type scenarios: int
+    :param seed: seed of the random generator
+    :type seed: int
+    :return: risk report
+    :rtype: RiskReport
+    """
+    items = {}
+    for recipe in recipes:
+        for item, _ in recipe.components + recipe.results:
+            items[item.name] = item
+
+    item_names = list(items)
+    prices = np.array([items[name].price or 0 for name in item_names], dtype=np.float64)
+    spreads = np.array([np.nan if items[name].price_spread is None else items[name].price_spread for name in item_names])
+    liquidity = np.array([items[name].liquidity or 0 for name in item_names], dtype=np.float64)
+    definitions = [{'name': recipe.name,
+                    'components': [[item.name, count] for item, count in recipe.components],
+                    'results': [[item.name, count] for item, count in recipe.results]} for recipe in recipes]
+
+    report = simulate(definitions, item_names, prices, spreads, liquidity, scenarios, seed)
+    for i, recipe in enumerate(recipes):
+        recipe.expected_profit = report.expected_profit[i].item()
+        recipe.loss_probability = report.loss_probability[i].item()
+        recipe.profit_p5 = report.profit_p5[i].item()
+        recipe.profit_p95 = report.profit_p95[i].item()
+    return report
+
+
+if __name__ == '__main__':
+    league = sys.argv[1] if len(sys.argv) > 1 else 'Ritual'
+    recipes = [Recipe(definition['name'], league, definition['components'], definition['results'], definition['wiki'])
+               for definition in load_recipe_definitions()]
+
+    start = time.perf_counter()
+    evaluate_recipes(recipes)
+    elapsed = time.perf_counter() - start
+
+    recipes.sort(key=lambda x: x.expected_profit, reverse=True)
+    print(f"{'Recipe':<45}{'Profit':>10}{'Expected':>10}{'P(loss)':>10}{'P5':>10}{'P95':>10}")
+    for recipe in recipes:
+        print(f"{recipe.name:<45}{recipe.profit:>10}{recipe.expected_profit:>10.1f}{recipe.loss_probability:>10.1%}"
+              f"{recipe.profit_p5:>10.1f}{recipe.profit_p95:>10.1f}")
+    print(f"{len(recipes)} recipes x {SCENARIOS} scenarios in {elapsed:.3f} s")
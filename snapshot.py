@@ -0,0 +1,295 @@
+import os
+import time
+import mmap
+import struct
+import sqlite3
+import numpy as np
+from datetime import datetime
+from item import create_tables
+
+SNAPSHOT_PATH = 'item_database.snap'
+SNAPSHOT_MAGIC = b'POESNAP\x00'
+SNAPSHOT_VERSION = 2
+# Published snapshots are never replaced while readers may map them (Windows can't replace or delete a mapped file), a
+# small pointer file names the current one. Older snapshots are deleted once nobody can still be about to open them
+KEEP_OLD_SNAPSHOTS_SECONDS = 60
+REPLACE_ATTEMPTS = 50
+
+# magic, version, number of items, league, offsets of: name index, item table, prices, liquidity, price spreads
+HEADER = struct.Struct('<8sII64s5Q')
+INDEX_DTYPE = np.dtype([('name', 'S64'), ('row', '<u4')])
+TABLE_DTYPE = np.dtype([('name', 'S64'),
+                        ('search_id', 'S32'),
+                        ('category', 'S16'),
+                        ('date_checked', '<i8')])
+
+
+def _align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _encode(value, width, field):
+    """
+    Encodes the value for a fixed width field, the layout would silently truncate longer values
+    """
+    encoded = (value or '').encode('utf8')
+    if len(encoded) > width:
+        raise ValueError(f"{field} \"{value}\" is longer than {width} bytes and doesn't fit in the snapshot")
+    return encoded
+
+
+def _retry_while_open(operation, *args):
+    """
+    Runs a replace or remove of the pointer file, waiting while a reader briefly has it open (which fails on Windows)
+    """
+    for attempt in range(REPLACE_ATTEMPTS):
+        try:
+            operation(*args)
+            return
+        except PermissionError:
+            if attempt == REPLACE_ATTEMPTS - 1:
+                raise
+            time.sleep(0.01)
+
+
+def _read_pointer(path):
+    """
+    Path of the snapshot the pointer file currently names
+    """
+    with open(path, 'rb') as f:
+        pointer = f.read(1024)
+    try:
+        name = pointer.decode('utf8').strip()
+    except UnicodeDecodeError:
+        name = ''
+    if not name.startswith(os.path.basename(path) + '.') or os.path.basename(name) != name:
+        # E.g. a snapshot of an older version, which was written directly to this path
+        raise EnvironmentError(f"\"{path}\" is not a price snapshot (version {SNAPSHOT_VERSION})")
+    return os.path.join(os.path.dirname(path), name)
+
+
+def _remove_old_snapshots(path, current):
+    directory = os.path.dirname(path) or '.'
+    prefix = os.path.basename(path) + '.'
+    for name in os.listdir(directory):
+        old = os.path.join(directory, name)
+        if not name.startswith(prefix) or name.endswith('.tmp') or os.path.basename(current) == name:
+            continue
+        try:
+            # Other publishers may just be pointing to theirs
+            if time.time() - os.path.getmtime(old) > KEEP_OLD_SNAPSHOTS_SECONDS:
+                os.remove(old)
+        except OSError:
+            # Still mapped by a reader (Windows), removed by a later publish
+            pass
+
+
+def publish_snapshot(league, database='item_database.db', path=SNAPSHOT_PATH):
+    """
+    Writes an immutable snapshot of all items of the league and atomically points the pointer file at it
+    Readers that still have the old snapshot open keep seeing it until they refresh
+    If publishing fails, the pointer is removed so that readers fall back to the database instead of a stale snapshot
+
+    :param league: name of the league
+    :type league: str
+    :param database: path to the database
+    :type database: str
+    :param path: path of the pointer file
+    :type path: str
+    :return: number of items in the snapshot
+    :rtype: int
+    """
+    try:
+        count = _write_snapshot(league, database, path)
+    except BaseException:
+        try:
+            _retry_while_open(os.remove, path)
+        except FileNotFoundError:
+            pass
+        raise
+    return count
+
+
+def _write_snapshot(league, database, path):
+    with sqlite3.connect(database) as connection:
+        create_tables(connection.cursor())
+        rows = connection.execute("""SELECT name, search_id, category, date_checked, price, liquidity, price_spread FROM items
+                                     WHERE league=:league""", {'league': league}).fetchall()
+
+    table = np.zeros(len(rows), dtype=TABLE_DTYPE)
+    prices = np.zeros(len(rows), dtype='<f8')
+    liquidity = np.zeros(len(rows), dtype='<i4')
+    spreads = np.full(len(rows), np.nan, dtype='<f8')
+    for row, (name, search_id, category, date_checked, price, item_liquidity, price_spread) in enumerate(rows):
+        table[row] = (_encode(name, TABLE_DTYPE['name'].itemsize, 'Item name'),
+                      _encode(search_id, TABLE_DTYPE['search_id'].itemsize, 'Search id'),
+                      _encode(category, TABLE_DTYPE['category'].itemsize, 'Category'),
+                      int((datetime.strptime(date_checked, "%Y-%m-%dT%H:%M:%SZ") - datetime(1970, 1, 1)).total_seconds()))
+        prices[row] = price or 0
+        liquidity[row] = item_liquidity or 0
+        if price_spread is not None:
+            spreads[row] = price_spread
+
+    # Name index sorted for binary search
+    index = np.zeros(len(rows), dtype=INDEX_DTYPE)
+    index['name'] = table['name']
+    index['row'] = np.arange(len(rows))
+    index.sort(order='name')
+
+    index_offset = _align(HEADER.size)
+    table_offset = _align(index_offset + index.nbytes)
+    prices_offset = _align(table_offset + table.nbytes)
+    liquidity_offset = _align(prices_offset + prices.nbytes)
+    spreads_offset = _align(liquidity_offset + liquidity.nbytes)
+    header = HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(rows), _encode(league, 64, 'League name'),
+                         index_offset, table_offset, prices_offset, liquidity_offset, spreads_offset)
+
+    # Write a new snapshot next to the pointer and make it durable, then point to it
+    snapshot_path = f"{path}.{time.time_ns()}-{os.getpid()}"
+    with open(snapshot_path, 'wb') as f:
+        for offset, data in ((0, header), (index_offset, index.tobytes()), (table_offset, table.tobytes()),
+                             (prices_offset, prices.tobytes()), (liquidity_offset, liquidity.tobytes()),
+                             (spreads_offset, spreads.tobytes())):
+            f.write(b'\x00' * (offset - f.tell()))
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, 'w', encoding='utf8') as f:
+        f.write(os.path.basename(snapshot_path))
+        f.flush()
+        os.fsync(f.fileno())
+    _retry_while_open(os.replace, temporary_path, path)
+    _remove_old_snapshots(path, snapshot_path)
+
+    return len(rows)
+
+
+class PriceSnapshot:
+
+    def __init__(self, path=SNAPSHOT_PATH):
+        """
+        Read-only, zero-copy view of a snapshot written by publish_snapshot
+        Lookups never touch the database, so any number of readers can run next to the refresher
+
+        :param path: path of the pointer file
+        :type path: str
+        """
+        self.path = path
+        self.snapshot_path = None
+        self._file = None
+        self._map = None
+        self.open()
+
+    def open(self):
+        """
+        Maps the snapshot the pointer file currently names into memory
+        """
+        self.snapshot_path = _read_pointer(self.path)
+        try:
+            self._file = open(self.snapshot_path, 'rb')
+        except FileNotFoundError:
+            raise EnvironmentError(f"\"{self.path}\" points to a missing price snapshot")
+        # Checked before mapping, an empty file can't be mapped at all
+        if os.fstat(self._file.fileno()).st_size < HEADER.size:
+            self.close()
+            raise EnvironmentError(f"\"{self.path}\" is not a price snapshot (version {SNAPSHOT_VERSION})")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, league, index_offset, table_offset, prices_offset, liquidity_offset, spreads_offset = \
+            HEADER.unpack_from(self._map)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            self.close()
+            raise EnvironmentError(f"\"{self.path}\" is not a price snapshot (version {SNAPSHOT_VERSION})")
+
+        self.league = league.rstrip(b'\x00').decode('utf8')
+        self.index = np.frombuffer(self._map, dtype=INDEX_DTYPE, count=count, offset=index_offset)
+        self.table = np.frombuffer(self._map, dtype=TABLE_DTYPE, count=count, offset=table_offset)
+        self.prices = np.frombuffer(self._map, dtype='<f8', count=count, offset=prices_offset)
+        self.liquidity = np.frombuffer(self._map, dtype='<i4', count=count, offset=liquidity_offset)
+        self.spreads = np.frombuffer(self._map, dtype='<f8', count=count, offset=spreads_offset)
+
+    def close(self):
+        """
+        Releases the mapping (arrays taken from this snapshot must not be used afterwards)
+        """
+        self.index = self.table = self.prices = self.liquidity = self.spreads = None
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Someone still holds a view, the mapping is released together with it
+                pass
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def refresh(self):
+        """
+        Reopens the snapshot if the refresher has published a new one since it was opened
+
+        :return: True if a new snapshot was loaded
+        :rtype: bool
+        :raises EnvironmentError: if there is no current snapshot anymore (e.g. the last publish failed)
+        """
+        if _read_pointer(self.path) == self.snapshot_path:
+            return False
+        self.close()
+        self.open()
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return self.row(name) is not None
+
+    def row(self, name):
+        """
+        Finds the row of the item in the snapshot arrays
+
+        :param name: name of the item
+        :type name: str
+        :return: row of the item, None if it is not in the snapshot
+        :rtype: int
+        """
+        encoded = name.encode('utf8')
+        if len(encoded) > INDEX_DTYPE['name'].itemsize:
+            # Longer names can't be in the snapshot, don't let the truncated key match another item
+            return None
+        key = np.array(encoded, dtype=INDEX_DTYPE['name'])
+        position = int(np.searchsorted(self.index['name'], key))
+        if position < len(self.index) and self.index['name'][position] == key:
+            return int(self.index['row'][position])
+        return None
+
+    def load_item(self, item):
+        """
+        Fills the item with the data from the snapshot
+
+        :param item: item with the name set
+        :type item: Item
+        :return: True if the item was found in the snapshot
+        :rtype: bool
+        """
+        row = self.row(item.name)
+        if row is None:
+            return False
+
+        record = self.table[row]
+        item.league = self.league
+        item.price = self.prices[row].item()
+        if item.price.is_integer():
+            item.price = int(item.price)
+        item.search_id = record['search_id'].decode('utf8')
+        item.liquidity = int(self.liquidity[row])
+        item.date_checked = datetime.utcfromtimestamp(int(record['date_checked']))
+        item.category = record['category'].decode('utf8')
+        item.price_spread = None if np.isnan(self.spreads[row]) else self.spreads[row].item()
+        return True
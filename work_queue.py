@@ -0,0 +1,298 @@
+import os
+import time
+import socket
+import sqlite3
+from random import shuffle
+
+QUEUE_DATABASE = 'work_queue.db'
+LEASE_SECONDS = 10 * 60
+MAX_ATTEMPTS = 5
+RETRY_DELAY_SECONDS = 60
+
+
+def worker_name():
+    """
+    Unique name of this worker process
+
+    :return: host and process id
+    :rtype: str
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _process_alive(pid):
+    if os.name == 'nt':
+        # os.kill would terminate the process on Windows
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        exit_code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+        kernel32.CloseHandle(handle)
+        return exit_code.value == 259  # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _dead_worker(owner):
+    """
+    Whether the worker (named by worker_name) ran on this host and its process is gone
+    """
+    host, _, pid = (owner or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return False
+    return not _process_alive(int(pid))
+
+
+class WorkQueue:
+
+    def __init__(self, path=QUEUE_DATABASE, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS):
+        """
+        Persistent queue of item refreshes, shared by all worker processes on the host
+        Every refresh pass is stored with the state of each of its items, so a pass resumes where it stopped
+
+        :param path: path to the queue database
+        :type path: str
+        :param lease_seconds: how long a worker may hold an item before others can take it over
+        :type lease_seconds: int
+        :param max_attempts: attempts after which a failing item is skipped until the next pass
+        :type max_attempts: int
+        """
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+
+        # Autocommit mode, transactions are opened explicitly with BEGIN IMMEDIATE
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS passes (id integer PRIMARY KEY,
+                                                                      league text,
+                                                                      started real,
+                                                                      finished real)""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS work_items (pass_id integer,
+                                                                          name text,
+                                                                          category text,
+                                                                          position integer,
+                                                                          state text,
+                                                                          attempts integer,
+                                                                          owner text,
+                                                                          not_before real,
+                                                                          last_error text,
+                                                                          PRIMARY KEY (pass_id, name))""")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS rate_limits (name text PRIMARY KEY,
+                                                                           tokens real,
+                                                                           updated real)""")
+
+    def close(self):
+        self.connection.close()
+
+    def _transaction(self):
+        """
+        Opens a write transaction (taking the write lock right away, so concurrent workers serialize here)
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+
+    def start_pass(self, league, items):
+        """
+        Returns the unfinished pass of the league, or creates a new one with the items in random order
+        Items named 'chaos_in_exalt' go first, because other prices are converted with it
+        Items leased by workers of this host that died are released right away, without waiting for their lease
+
+        :param league: name of the league
+        :type league: str
+        :param items: names and categories of the items to refresh
+        :type items: list[tuple[str, str]]
+        :return: id of the pass
+        :rtype: int
+        """
+        self._transaction()
+        try:
+            unfinished = self.connection.execute("SELECT id FROM passes WHERE league=? AND finished IS NULL ORDER BY id LIMIT 1",
+                                                 (league,)).fetchone()
+            if unfinished:
+                pass_id = unfinished[0]
+                owners = self.connection.execute("SELECT DISTINCT owner FROM work_items WHERE pass_id=? AND state='leased'",
+                                                 (pass_id,)).fetchall()
+                for owner, in owners:
+                    if _dead_worker(owner):
+                        self.connection.execute("""UPDATE work_items SET state=CASE WHEN attempts>=? THEN 'failed' ELSE 'pending' END,
+                                                                         not_before=0,
+                                                                         last_error='worker died'
+                                                   WHERE pass_id=? AND state='leased' AND owner=?""",
+                                                (self.max_attempts, pass_id, owner))
+            else:
+                items = list(items)
+                shuffle(items)
+                items.sort(key=lambda x: x[0] != 'chaos_in_exalt')
+                pass_id = self.connection.execute("INSERT INTO passes (league, started) VALUES (?, ?)", (league, time.time())).lastrowid
+                self.connection.executemany("INSERT INTO work_items VALUES (?, ?, ?, ?, 'pending', 0, NULL, 0, NULL)",
+                                            [(pass_id, name, category, position) for position, (name, category) in enumerate(items)])
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return pass_id
+
+    def claim(self, pass_id, owner):
+        """
+        Leases the next available item of the pass to the worker
+        Pending items are available once their retry delay passed, leased items once their lease expired
+
+        :param pass_id: id of the pass
+        :type pass_id: int
+        :param owner: unique name of the worker
+        :type owner: str
+        :return: name and category of the item, None if nothing is available right now
+        :rtype: tuple[str, str]
+        """
+        now = time.time()
+        self._transaction()
+        try:
+            # Workers that died holding their last attempt don't get another one
+            self.connection.execute("""UPDATE work_items SET state='failed', last_error='lease expired'
+                                       WHERE pass_id=? AND state='leased' AND not_before<=? AND attempts>=?""",
+                                    (pass_id, now, self.max_attempts))
+            row = self.connection.execute("""SELECT name, category FROM work_items
+                                             WHERE pass_id=? AND state IN ('pending', 'leased') AND not_before<=?
+                                             ORDER BY position LIMIT 1""", (pass_id, now)).fetchone()
+            if row:
+                self.connection.execute("""UPDATE work_items SET state='leased', attempts=attempts+1, owner=?, not_before=?
+                                           WHERE pass_id=? AND name=?""", (owner, now + self.lease_seconds, pass_id, row[0]))
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return row
+
+    def renew(self, pass_id, name, owner):
+        """
+        Extends the lease of the item by a full lease from now
+
+        :param pass_id: id of the pass
+        :type pass_id: int
+        :param name: name of the item
+        :type name: str
+        :param owner: unique name of the worker
+        :type owner: str
+        :return: False if the lease expired and another worker took the item over
+        :rtype: bool
+        """
+        cursor = self.connection.execute("UPDATE work_items SET not_before=? WHERE pass_id=? AND name=? AND owner=? AND state='leased'",
+                                         (time.time() + self.lease_seconds, pass_id, name, owner))
+        return cursor.rowcount > 0
+
+    def complete(self, pass_id, name, owner):
+        """
+        Marks the leased item as refreshed
+
+        :param pass_id: id of the pass
+        :type pass_id: int
+        :param name: name of the item
+        :type name: str
+        :param owner: unique name of the worker
+        :type owner: str
+        """
+        self.connection.execute("UPDATE work_items SET state='done', last_error=NULL WHERE pass_id=? AND name=? AND owner=?",
+                                (pass_id, name, owner))
+
+    def fail(self, pass_id, name, owner, error):
+        """
+        Returns the leased item to the queue (with a growing delay) or gives up on it after too many attempts
+
+        :param pass_id: id of the pass
+        :type pass_id: int
+        :param name: name of the item
+        :type name: str
+        :param owner: unique name of the worker
+        :type owner: str
+        :param error: what went wrong
+        :type error: str
+        """
+        self.connection.execute("""UPDATE work_items SET state=CASE WHEN attempts>=? THEN 'failed' ELSE 'pending' END,
+                                                         not_before=? + ? * (1 << (attempts - 1)),
+                                                         last_error=?
+                                   WHERE pass_id=? AND name=? AND owner=?""",
+                                (self.max_attempts, time.time(), RETRY_DELAY_SECONDS, error, pass_id, name, owner))
+
+    def finish_pass(self, pass_id):
+        """
+        Closes the pass if none of its items is pending or leased anymore
+
+        :param pass_id: id of the pass
+        :type pass_id: int
+        :return: True if the pass is finished
+        :rtype: bool
+        """
+        self._transaction()
+        try:
+            remaining = self.connection.execute("SELECT COUNT(*) FROM work_items WHERE pass_id=? AND state IN ('pending', 'leased')",
+                                                (pass_id,)).fetchone()[0]
+            if not remaining:
+                self.connection.execute("UPDATE passes SET finished=? WHERE id=? AND finished IS NULL", (time.time(), pass_id))
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return not remaining
+
+    def progress(self, pass_id):
+        """
+        Counts the items of the pass in every state
+
+        :param pass_id: id of the pass
+        :type pass_id: int
+        :return: number of items per state
+        :rtype: dict
+        """
+        return dict(self.connection.execute("SELECT state, COUNT(*) FROM work_items WHERE pass_id=? GROUP BY state", (pass_id,)).fetchall())
+
+
+class RateLimiter:
+
+    def __init__(self, queue, name, interval_seconds, burst=1):
+        """
+        Token bucket kept in the queue database, so all workers of the host share one request budget
+
+        :param queue: work queue whose database holds the bucket
+        :type queue: WorkQueue
+        :param name: name of the budget
+        :type name: str
+        :param interval_seconds: one token is added every interval
+        :type interval_seconds: float
+        :param burst: maximal number of saved up tokens
+        :type burst: int
+        """
+        self.queue = queue
+        self.name = name
+        self.interval_seconds = interval_seconds
+        self.burst = burst
+
+    def acquire(self):
+        """
+        Blocks until a token is available and takes it
+        """
+        while True:
+            now = time.time()
+            self.queue._transaction()
+            try:
+                row = self.queue.connection.execute("SELECT tokens, updated FROM rate_limits WHERE name=?", (self.name,)).fetchone()
+                tokens = self.burst if row is None else min(self.burst, row[0] + (now - row[1]) / self.interval_seconds)
+                taken = tokens >= 1
+                if taken:
+                    tokens -= 1
+                self.queue.connection.execute("INSERT OR REPLACE INTO rate_limits VALUES (?, ?, ?)", (self.name, tokens, now))
+                self.queue.connection.execute("COMMIT")
+            except BaseException:
+                self.queue.connection.execute("ROLLBACK")
+                raise
+
+            if taken:
+                return
+            # Wait until the next token is due
+            time.sleep((1 - tokens) * self.interval_seconds)